@@ -10,8 +10,12 @@ import io
 import base64
 import json
 import seaborn as sns
-from matplotlib.patches import Polygon
+from matplotlib.patches import Polygon, Patch
 import warnings
+import threading
+from functools import lru_cache
+from matplotlib.font_manager import FontProperties
+from matplotlib.backends.backend_agg import RendererAgg
 warnings.filterwarnings('ignore')
 
 # Set matplotlib to use non-interactive backend
@@ -24,6 +28,45 @@ CORS(app)
 plt.style.use('default')
 sns.set_palette("husl")
 
+# Fraction of each category slot filled by a group of side-by-side bars
+BAR_GROUP_WIDTH = 0.8
+
+# Flask serves requests on threads and RendererAgg is not thread-safe, so each thread measures text with its own
+text_renderers = threading.local()
+
+def get_text_renderer():
+    """Return this thread's renderer for measuring text, at 72 dpi so that measured pixels are points"""
+    if not hasattr(text_renderers, 'renderer'):
+        text_renderers.renderer = RendererAgg(1, 1, 72)
+    return text_renderers.renderer
+
+@lru_cache(maxsize=4096)
+def cached_text_extent(text, fontsize, fontweight, fontfamily):
+    """Return the (width, height) of a label in points, cached per font, size and string"""
+    renderer = get_text_renderer()
+    prop = FontProperties(family=list(fontfamily), size=fontsize, weight=fontweight)
+    # Lines are stacked the way matplotlib 3.7 lays them out: each at least as tall as 'lp', spaced by 1.2
+    _, lp_height, lp_descent = renderer.get_text_width_height_descent('lp', prop, ismath=False)
+    width, height = 0.0, 0.0
+    for i, line in enumerate(text.split('\n')):
+        line_width, line_height, descent = renderer.get_text_width_height_descent(line, prop, ismath=False) if line else (0.0, 0.0, 0.0)
+        line_height, descent = max(line_height, lp_height), max(descent, lp_descent)
+        width = max(width, line_width)
+        height += line_height - descent if i == 0 else max(lp_height - lp_descent, line_height - descent) * 1.2
+        height += descent
+    return width, height
+
+def get_text_extent(text, fontsize, fontweight='normal'):
+    """Return the (width, height) of a label in points using the current font family"""
+    return cached_text_extent(text, fontsize, fontweight, tuple(matplotlib.rcParams['font.family']))
+
+def format_thousands(values):
+    """Format a sequence of numbers as comma-separated integer labels, leaving NaN and inf unlabelled"""
+    values = np.asarray(values, dtype=float)
+    finite = np.isfinite(values)
+    integers = np.where(finite, values, 0).astype(np.int64)
+    return [f'{v:,}' if ok else '' for v, ok in zip(integers.tolist(), finite.tolist())]
+
 class CurveGenerator:
     def __init__(self):
         self.color_schemes = {
@@ -58,13 +101,14 @@ class CurveGenerator:
                     ax.grid(True, **grid_config)
                     ax.set_axisbelow(True)  # Put grid behind data
             
-            # Generate chart based on type
+            # Generate chart based on type; bar and pie charts return a callback that places their labels
+            layout_labels = None
             if curve_type == 'line':
                 self.create_line_chart(ax, data, colors, x_axis_label, y_axis_label)
             elif curve_type == 'bar':
-                self.create_bar_chart(ax, data, colors, x_axis_label, y_axis_label)
+                layout_labels = self.create_bar_chart(ax, data, colors, x_axis_label, y_axis_label)
             elif curve_type == 'pie':
-                self.create_pie_chart(ax, data, colors, title)
+                layout_labels = self.create_pie_chart(ax, data, colors, title)
             elif curve_type == 'area':
                 self.create_area_chart(ax, data, colors, x_axis_label, y_axis_label)
             elif curve_type == 'spline':
@@ -124,6 +168,13 @@ class CurveGenerator:
             
             plt.tight_layout()
             
+            # Thin labels against the axes left once legends and layout have taken their space,
+            # then lay out again so that the labels which were kept get room as well
+            if layout_labels is not None:
+                layout_labels(show_x_axis)
+                plt.tight_layout()
+                layout_labels(show_x_axis)
+            
             # Convert to base64
             buffer = io.BytesIO()
             plt.savefig(buffer, format='png', dpi=300, bbox_inches='tight', 
@@ -173,102 +224,253 @@ class CurveGenerator:
             ax.yaxis.set_major_formatter(plt.FuncFormatter(lambda x, p: f'{int(x):,}'))
             ax.tick_params(axis='both', which='major', labelsize=10)
 
+    def axes_size_points(self, ax):
+        """Return the (width, height) of the axes in points"""
+        bbox = ax.get_window_extent()
+        scale = 72.0 / ax.figure.dpi
+        return bbox.width * scale, bbox.height * scale
+
+    def widest_label(self, labels, fontsize, fontweight='bold', rotation=0):
+        """Return the largest extent along the x axis, in points, of any label in the sequence"""
+        axis = 1 if rotation == 90 else 0
+        labels = [label for label in set(labels) if label]
+        # Rank labels by their summed character extents and measure only the likely largest ones exactly
+        chars = {char: get_text_extent(char, fontsize, fontweight) for char in set(''.join(labels)) if char != '\n'}
+        if axis == 0:
+            estimates = [max(sum(chars[char][0] for char in line) for line in label.split('\n')) for label in labels]
+        else:
+            estimates = [max((chars[char][1] for char in label if char != '\n'), default=0.0) * (label.count('\n') + 1)
+                         for label in labels]
+        candidates = [labels[i] for i in np.argsort(estimates, kind='stable')[-8:]]
+        return max((get_text_extent(label, fontsize, fontweight)[axis] for label in candidates), default=0.0)
+
+    def points_per_unit(self, ax):
+        """Return how many points one data unit along the x axis spans"""
+        x_min, x_max = ax.get_xlim()
+        axes_width, _ = self.axes_size_points(ax)
+        return axes_width / max(abs(x_max - x_min), 1e-9)
+
+    def add_bar_labels(self, ax, x, series_values, bar_width, categories, fontsize,
+                       rotation=0, tick_fontweight='normal'):
+        """Add value and tick labels for groups of side-by-side bars and return a callback that redoes them after layout"""
+        x = np.asarray(x, dtype=float)
+        n_series = len(series_values)
+        n_groups = min([len(x)] + [len(values) for values in series_values])
+        heights = np.array([np.asarray(values, dtype=float)[:n_groups] for values in series_values]).reshape(n_series, n_groups)
+        value_labels = [format_thousands(row) for row in heights]
+        tick_labels = [str(category) for category in categories]
+        
+        value_extent = max((self.widest_label(row, fontsize, 'bold', rotation) for row in value_labels), default=0.0)
+        tick_extent = self.widest_label(tick_labels, 10, tick_fontweight)
+        group_pitch = x[1] - x[0] if len(x) > 1 else 1.0
+        centres = x + (n_series - 1) / 2 * bar_width if n_series else x
+        
+        # When labels are wider than a bar, only the tallest bar of each group is labelled
+        finite_heights = np.where(np.isfinite(heights), heights, -np.inf)
+        tallest = np.argmax(finite_heights, axis=0) if n_series else np.zeros(n_groups, dtype=int)
+        texts = []
+        
+        def place_labels(show_ticks=True):
+            for text in texts:
+                text.remove()
+            texts.clear()
+            
+            # Strides are counted in whole groups so that ticks and every series drop the same groups
+            scale = self.points_per_unit(ax)
+            value_width = value_extent * 1.1 / scale
+            all_series = n_series > 1 and value_width <= bar_width
+            if all_series:
+                value_stride = 1
+            else:
+                # Labels of neighbouring groups can be as close as the group pitch less the group width
+                value_stride = int(np.ceil((value_width + (n_series - 1) * bar_width) / group_pitch))
+            tick_stride = int(np.ceil(tick_extent * 1.1 / scale / group_pitch))
+            stride = max(1, value_stride, tick_stride)
+            
+            if show_ticks:
+                ax.set_xticks(centres[::stride])
+                ax.set_xticklabels(tick_labels[::stride], rotation=0, ha='center', fontsize=10, fontweight=tick_fontweight)
+            
+            groups = np.arange(0, n_groups, stride)
+            if all_series:
+                rows, cols = np.repeat(np.arange(n_series), len(groups)), np.tile(groups, n_series)
+            else:
+                rows, cols = tallest[groups], groups
+            label_x = x[cols] + rows * bar_width
+            label_y = heights[rows, cols] * 1.01
+            
+            # Leave out labels that would sit under a legend drawn inside the axes
+            legend = ax.get_legend()
+            if legend is not None and len(cols):
+                legend_box = legend.get_window_extent(ax.figure.canvas.get_renderer())
+                anchors = ax.transData.transform(np.column_stack([label_x, np.where(np.isfinite(label_y), label_y, 0)]))
+                width, height = get_text_extent(max(value_labels[0], key=len), fontsize, 'bold')
+                width, height = (height, width) if rotation == 90 else (width, height)
+                width, height = width * ax.figure.dpi / 72, height * ax.figure.dpi / 72
+                clear = ((anchors[:, 0] + width / 2 < legend_box.x0) | (anchors[:, 0] - width / 2 > legend_box.x1) |
+                         (anchors[:, 1] + height < legend_box.y0) | (anchors[:, 1] > legend_box.y1))
+                rows, cols, label_x, label_y = rows[clear], cols[clear], label_x[clear], label_y[clear]
+            
+            for row, col, xi, yi in zip(rows, cols, label_x, label_y):
+                if not value_labels[row][col]:
+                    continue
+                texts.append(ax.text(xi, yi, value_labels[row][col], ha='center', va='bottom',
+                                    fontsize=fontsize, fontweight='bold', rotation=rotation))
+        
+        place_labels()
+        return place_labels
+
     def create_bar_chart(self, ax, data, colors, x_label, y_label):
-        """Create a bar chart"""
+        """Create a bar chart and return the callback that places its labels"""
         if 'categories' in data and 'revenue' in data:
             categories = data['categories']
             revenue = data['revenue']
             x_pos = np.arange(len(categories))
             
-            bars = ax.bar(x_pos, revenue, color=colors[0], alpha=0.8, 
-                         edgecolor=colors[0], linewidth=2)
+            ax.bar(x_pos, revenue, color=colors[0], alpha=0.8, 
+                  edgecolor=colors[0], linewidth=2)
             
             if 'costs' in data:
                 costs = data['costs']
                 ax.bar(x_pos, costs, color=colors[1], alpha=0.8, 
                       edgecolor=colors[1], linewidth=2, bottom=revenue)
             
-            ax.set_xticks(x_pos)
-            ax.set_xticklabels(categories, rotation=0, ha='center')
-            
-            # Add value labels on bars
-            for bar in bars:
-                height = bar.get_height()
-                ax.text(bar.get_x() + bar.get_width()/2., height + height*0.01,
-                       f'{int(height):,}', ha='center', va='bottom', fontsize=10, fontweight='bold')
+            # Add tick and value labels on bars
+            return self.add_bar_labels(ax, x_pos, [revenue], BAR_GROUP_WIDTH, categories, fontsize=10)
         else:
             # Generic bar chart - handle multiple series like the Google Colab example
             keys = list(data.keys())
             if 'years' in data:
                 years = data['years']
-                bar_width = 0.13
+                series = [(domain, values) for domain, values in data.items() if domain != 'years']
+                bar_width = BAR_GROUP_WIDTH / max(len(series), 1)
                 x = np.arange(len(years))
                 
-                for i, (domain, values) in enumerate(data.items()):
-                    if domain != 'years':
-                        ax.bar([p + i * bar_width for p in x], values, width=bar_width, 
-                              label=domain, color=colors[i % len(colors)], alpha=0.8)
+                for i, (domain, values) in enumerate(series):
+                    ax.bar(x + i * bar_width, values, width=bar_width, 
+                          label=domain, color=colors[i % len(colors)], alpha=0.8)
                 
-                ax.set_xticks([p + 2.5 * bar_width for p in x])
-                ax.set_xticklabels(years, rotation=0, ha='center', fontsize=10, fontweight='bold')
                 ax.legend(bbox_to_anchor=(1.05, 1), loc='upper left')
                 
                 # Ensure Y-axis shows proper tick values
                 ax.yaxis.set_major_formatter(plt.FuncFormatter(lambda x, p: f'{int(x):,}'))
                 ax.tick_params(axis='both', which='major', labelsize=10)
                 
-                # Add value labels on bars
-                for i, (domain, values) in enumerate(data.items()):
-                    if domain != 'years':
-                        for j, value in enumerate(values):
-                            ax.text(x[j] + i * bar_width, value + value*0.01,
-                                   f'{int(value):,}', ha='center', va='bottom', 
-                                   fontsize=8, fontweight='bold', rotation=90)
+                # Add tick and value labels on bars
+                return self.add_bar_labels(ax, x, [values for _, values in series], bar_width, years,
+                                           fontsize=8, rotation=90, tick_fontweight='bold')
             else:
                 # Fallback for other data formats
                 categories = data[keys[0]] if len(keys) > 0 else []
-                for i, key in enumerate(keys[1:]):
-                    values = data[key]
-                    x_pos = np.arange(len(categories))
-                    bars = ax.bar(x_pos + i * 0.2, values, color=colors[i % len(colors)], 
-                                 alpha=0.8, width=0.2, label=key)
-                    
-                    # Add value labels
-                    for bar in bars:
-                        height = bar.get_height()
-                        ax.text(bar.get_x() + bar.get_width()/2., height + height*0.01,
-                               f'{int(height):,}', ha='center', va='bottom', fontsize=8, fontweight='bold')
+                series_keys = keys[1:]
+                bar_width = BAR_GROUP_WIDTH / max(len(series_keys), 1)
+                x_pos = np.arange(len(categories))
+                for i, key in enumerate(series_keys):
+                    ax.bar(x_pos + i * bar_width, data[key], color=colors[i % len(colors)], 
+                          alpha=0.8, width=bar_width, label=key)
                 
-                ax.set_xticks(x_pos + 0.1)
-                ax.set_xticklabels(categories, rotation=0, ha='center')
                 ax.legend()
+                
+                # Add tick and value labels
+                return self.add_bar_labels(ax, x_pos, [data[key] for key in series_keys], bar_width, categories, fontsize=8)
+
+    def add_pie_legend(self, ax, wedges, labels, values):
+        """Add the categories legend, folding the smallest wedges into one line when they do not fit down the figure"""
+        count = min(len(wedges), len(labels))
+        fontsize = FontProperties(size=matplotlib.rcParams['legend.fontsize']).get_size_in_points()
+        _, text_height = get_text_extent('Categories', fontsize)
+        entry_height = text_height + matplotlib.rcParams['legend.labelspacing'] * fontsize
+        # Two entries are kept back for the legend title and the line counting the wedges left out
+        capacity = max(1, int(ax.figure.get_figheight() * 72 * 0.9 / entry_height) - 2)
+        
+        handles, names = list(wedges[:count]), list(labels[:count])
+        if count > capacity:
+            values = np.asarray(values[:count], dtype=float)
+            kept = np.sort(np.argsort(-values, kind='stable')[:capacity])
+            handles = [wedges[i] for i in kept] + [Patch(color='none')]
+            names = [labels[i] for i in kept] + [f'+ {count - capacity} more']
+        ax.legend(handles, names, title="Categories", loc="center left", bbox_to_anchor=(1, 0, 0.5, 1))
+
+    def add_pie_labels(self, ax, wedges, labels, values):
+        """Add wedge and percentage labels and return a callback that redoes them after layout"""
+        custom_labels = [f'{label}\n({value:,})' for label, value in zip(labels, values)]
+        values = np.asarray(values, dtype=float)
+        total = values.sum()
+        fractions = values / total if total > 0 else np.zeros_like(values)
+        percentages = [f'{100 * fraction:.1f}%' for fraction in fractions]
+        angles = np.radians([(wedge.theta1 + wedge.theta2) / 2 for wedge in wedges])
+        order = np.argsort(-fractions, kind='stable')
+        texts = []
+        
+        def place_labels(show_ticks=True):
+            for text in texts:
+                text.remove()
+            texts.clear()
+            
+            # Boxes are worked out on the axes as drawn, so apply the equal aspect the pie asked for first
+            ax.apply_aspect()
+            renderer = ax.figure.canvas.get_renderer()
+            scale = ax.figure.dpi / 72
+            legend = ax.get_legend()
+            taken = []
+            if legend is not None:
+                box = legend.get_window_extent(renderer)
+                taken.append([box.x0, box.y0, box.x1, box.y1])
+            
+            def overlaps(box):
+                boxes = np.asarray(taken).reshape(-1, 4)
+                return bool(np.any((boxes[:, 0] < box[2]) & (box[0] < boxes[:, 2]) &
+                                   (boxes[:, 1] < box[3]) & (box[1] < boxes[:, 3])))
+            
+            def try_place(x, y, text, fontsize, ha):
+                """Add the label if its box, taken from the wedge angle and alignment, is clear of every other label"""
+                width, height = get_text_extent(text, fontsize, 'bold')
+                width, height = width * scale + 2, height * scale + 2
+                anchor_x, anchor_y = ax.transData.transform((x, y))
+                x0 = {'left': anchor_x, 'right': anchor_x - width, 'center': anchor_x - width / 2}[ha]
+                box = [x0, anchor_y - height / 2, x0 + width, anchor_y + height / 2]
+                if overlaps(box):
+                    return
+                # The cached extent screens out most labels cheaply; the few that pass are checked as drawn
+                label = ax.text(x, y, text, ha=ha, va='center', color='#000000', fontsize=fontsize, fontweight='bold')
+                drawn = label.get_window_extent(renderer)
+                box = [drawn.x0 - 1, drawn.y0 - 1, drawn.x1 + 1, drawn.y1 + 1]
+                if overlaps(box):
+                    label.remove()
+                    return
+                taken.append(box)
+                texts.append(label)
+            
+            # Larger wedges are labelled first, so crowded small wedges are the ones left without text
+            for i in order:
+                if fractions[i] <= 0:
+                    continue
+                center_x, center_y = wedges[i].center
+                radius = wedges[i].r
+                cos, sin = np.cos(angles[i]), np.sin(angles[i])
+                if i < len(custom_labels):
+                    try_place(center_x + 1.1 * radius * cos, center_y + 1.1 * radius * sin,
+                              custom_labels[i], 10, 'left' if cos > 0 else 'right')
+                try_place(center_x + 0.6 * radius * cos, center_y + 0.6 * radius * sin,
+                          percentages[i], 9, 'center')
+        
+        place_labels()
+        return place_labels
 
     def create_pie_chart(self, ax, data, colors, title):
-        """Create a pie chart"""
+        """Create a pie chart and return the callback that places its labels"""
         if 'labels' in data and 'values' in data:
             labels = data['labels']
             values = data['values']
             
-            # Calculate percentages for better labels
-            total = sum(values)
-            percentages = [f'{(v/total)*100:.1f}%' for v in values]
-            
-            # Create custom labels with values and percentages
-            custom_labels = [f'{label}\n({value:,})' for label, value in zip(labels, values)]
-            
-            wedges, texts, autotexts = ax.pie(values, labels=custom_labels, 
-                                             startangle=90, colors=colors[:len(values)],
-                                             textprops={'color': '#000000', 'fontsize': 10, 'fontweight': 'bold'},
-                                             autopct=lambda pct: f'{pct:.1f}%')
-            
-            # Style the percentage text
-            for autotext in autotexts:
-                autotext.set_color('#000000')
-                autotext.set_fontweight('bold')
-                autotext.set_fontsize(9)
+            # Labels are placed separately, once the final size of the pie is known
+            wedges = ax.pie(values, startangle=90, colors=colors[:len(values)], labeldistance=None)[0]
             
             # Add a legend
-            ax.legend(wedges, labels, title="Categories", loc="center left", bbox_to_anchor=(1, 0, 0.5, 1))
+            self.add_pie_legend(ax, wedges, labels, values)
+            
+            # Add custom labels with values and percentages
+            return self.add_pie_labels(ax, wedges, labels, values)
             
         else:
             # Generic pie chart
@@ -277,22 +479,13 @@ class CurveGenerator:
             labels = keys[1:] if len(keys) > 1 else []
             
             if len(values) > 0:
-                total = sum(values)
-                custom_labels = [f'{label}\n({value:,})' for label, value in zip(labels, values)]
-                
-                wedges, texts, autotexts = ax.pie(values, labels=custom_labels, 
-                                                 startangle=90, colors=colors[:len(values)],
-                                                 textprops={'color': '#000000', 'fontsize': 10, 'fontweight': 'bold'},
-                                                 autopct=lambda pct: f'{pct:.1f}%')
-                
-                # Style the percentage text
-                for autotext in autotexts:
-                    autotext.set_color('#000000')
-                    autotext.set_fontweight('bold')
-                    autotext.set_fontsize(9)
+                wedges = ax.pie(values, startangle=90, colors=colors[:len(values)], labeldistance=None)[0]
                 
                 # Add a legend
-                ax.legend(wedges, labels, title="Categories", loc="center left", bbox_to_anchor=(1, 0, 0.5, 1))
+                self.add_pie_legend(ax, wedges, labels, values)
+                
+                # Add custom labels with values and percentages
+                return self.add_pie_labels(ax, wedges, labels, values)
 
     def create_area_chart(self, ax, data, colors, x_label, y_label):
         """Create an area chart"""